@@ -1,12 +1,14 @@
 import os
+import sys
 from enum import Enum
-import json
 import time
+import threading
+import queue
+import atexit
+import functools
 
-import logging
-from logging.handlers import RotatingFileHandler
-
-from defaults import METADATA_FILE_NAME, MAX_FILE_SIZE_BYTES, MAX_FILE_COUNT
+from defaults import METADATA_FILE_NAME, MAX_FILE_SIZE_BYTES, MAX_FILE_COUNT, DATA_BUFFER_SIZE_BYTES, \
+    DATA_FLUSH_INTERVAL_SEC, DATA_DRAIN_BATCH_COUNT, DATA_DRAIN_TIMEOUT_SEC
 
 
 class DataType(Enum):
@@ -17,6 +19,20 @@ class DataType(Enum):
     EXCEPTION = 3
 
 
+SUPPORTED_DATA_TYPES = str([{i.name: i.value for i in DataType}])
+WRITABLE_DATA_TYPES = frozenset((DataType.INFO, DataType.WARNING, DataType.ERROR, DataType.EXCEPTION))
+
+# The lowest data type value written for each logging level
+LOGGING_LEVELS = {
+    "DEBUG": DataType.INFO.value,
+    "INFO": DataType.INFO.value,
+    "WARNING": DataType.WARNING.value,
+    "ERROR": DataType.ERROR.value,
+    "CRITICAL": DataType.EXCEPTION.value + 1
+}
+
+DATA_FILE_ENCODING = "utf-8"
+
 METADATA = {
     "__data_collection_version": "1.0.0",
 
@@ -24,12 +40,200 @@ METADATA = {
     "collection_end": -1
 }
 
+# The metadata file is append-only: each update adds one row with the key ("k"), the value ("v"), and the time of the
+# update ("t"). The rows have a fixed schema, so they are serialized by filling in this template rather than by a generic
+# JSON encoder
+METADATA_ROW_TEMPLATE = '{{"k":"{0}","v":{1},"t":{2}}}\n'
+
+
+if hasattr(os, "writev"):
+    def _write_chunks(fd, chunks):
+        return os.writev(fd, chunks)
+else:
+    def _write_chunks(fd, chunks):
+        return os.write(fd, b"".join(chunks))
+
+
+def _report_write_error(error):
+    sys.stderr.write("Cannot write to the data file: {0!r}\n".format(error))
+
+
+def load_metadata(metadata_file_path):
+    """
+    Rebuild the latest metadata by replaying the rows of a metadata file.
+
+    :param metadata_file_path: The path to the metadata file (including the filename)
+    :type: str
+    :return: The latest value of each metadata key
+    :rtype: dict
+    """
+    import json
+
+    metadata = {}
+    with open(metadata_file_path, 'r') as metadata_file:
+        for line in metadata_file:
+            if line.strip():
+                row = json.loads(line)
+                metadata[row["k"]] = row["v"]
+    return metadata
+
+
+class ThermalSink:
+    """
+    Appends data to a rotating set of data files. When the data file reaches its maximum size, it is renamed with the
+    ".1" suffix, the existing ".1", ".2", ... files are shifted up by one, and the oldest one beyond the maximum file
+    count is overwritten.
+
+    Data is accumulated in a reused in-memory buffer, and written with a single write on the data file descriptor when
+    the buffer fills up, before a rotation, on demand, and on close. Data that must go out right away is not copied into
+    the buffer: its chunks are gathered with the buffered data by a single writev.
+    """
+    def __init__(self, file_path, max_file_size, max_file_count, buffer_size=DATA_BUFFER_SIZE_BYTES):
+        """
+        Open the data file for appending.
+
+        :param file_path: The path to the data file
+        :type: str
+        :param max_file_size: The maximum size, in bytes, of a data file. If 0, never rotate
+        :type: int
+        :param max_file_count: The maximum number of rotated data files to keep. If 0, never rotate
+        :type: int
+        :param buffer_size: The number of bytes to accumulate before writing them to the data file
+        :type: int
+        """
+        self._lock = threading.Lock()
+        # The same buffer is reused for the lifetime of the sink; writing it out only empties it
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+        self._open(file_path, max_file_size, max_file_count)
+
+    def _open(self, file_path, max_file_size, max_file_count):
+        self._file_path = file_path
+        self._max_file_size = max_file_size
+        self._max_file_count = max_file_count
+        self._fd = os.open(self._file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
+        self._file_size = os.fstat(self._fd).st_size
+
+    def write(self, data, flush=False):
+        """
+        Append data to the data file, rotating the data file first if the data would make it reach its maximum size.
+
+        :param data: The data to append, either as a single chunk, or as a sequence of chunks to append in order
+        :type: bytes or list
+        :param flush: True to write the data to the data file right away; False to let it wait in the buffer
+        :type: bool
+        """
+        if isinstance(data, bytes):
+            data = (data,)
+        data_size = sum(len(chunk) for chunk in data)
+
+        with self._lock:
+            try:
+                if self._max_file_size > 0 and self._max_file_count > 0 and \
+                        self._file_size + len(self._buffer) + data_size >= self._max_file_size:
+                    self._flush()
+                    self._rotate()
+            except Exception:
+                # Keep the data even if the rotation failed, so that it is written with the next flush
+                self._buffer_chunks(data)
+                raise
+
+            if flush:
+                self._flush(data)
+            else:
+                self._buffer_chunks(data)
+                if len(self._buffer) >= self._buffer_size:
+                    self._flush()
+
+    def _buffer_chunks(self, chunks):
+        for chunk in chunks:
+            self._buffer += chunk
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self, chunks=()):
+        """
+        Write the buffered data, followed by the given chunks, to the data file.
+
+        :param chunks: The chunks of a single record to write after the buffered data, without buffering them first
+        :type: list
+        """
+        if not self._buffer and not chunks:
+            return
+
+        try:
+            if self._fd is None:
+                # A previous rotation or reset could not reopen the data file
+                self._open(self._file_path, self._max_file_size, self._max_file_count)
+            written = _write_chunks(self._fd, [self._buffer] + list(chunks)) if chunks else \
+                os.write(self._fd, self._buffer)
+        except Exception:
+            self._buffer_chunks(chunks)
+            raise
+
+        self._file_size += written
+        if written == len(self._buffer) + sum(len(chunk) for chunk in chunks):
+            self._buffer.clear()
+            return
+
+        # Partial write: keep the rest in the buffer, and write it out
+        self._buffer_chunks(chunks)
+        del self._buffer[:written]
+        while self._buffer:
+            written = os.write(self._fd, self._buffer)
+            self._file_size += written
+            del self._buffer[:written]
+
+    def _close_fd(self):
+        # Forget the descriptor before closing it, so that it is never written to after its number is reused
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def _rotate(self):
+        self._close_fd()
+        try:
+            for i in range(self._max_file_count - 1, 0, -1):
+                rotated_file_path = "{0}.{1}".format(self._file_path, i)
+                if os.path.exists(rotated_file_path):
+                    os.replace(rotated_file_path, "{0}.{1}".format(self._file_path, i + 1))
+            os.replace(self._file_path, self._file_path + ".1")
+        finally:
+            self._open(self._file_path, self._max_file_size, self._max_file_count)
+
+    def reset(self, file_path, max_file_size, max_file_count):
+        """
+        Write out the buffered data, and direct the next data to a different data file.
+
+        :param file_path: The path to the new data file
+        :type: str
+        :param max_file_size: The maximum size, in bytes, of a data file. If 0, never rotate
+        :type: int
+        :param max_file_count: The maximum number of rotated data files to keep. If 0, never rotate
+        :type: int
+        """
+        with self._lock:
+            try:
+                self._flush()
+            finally:
+                self._close_fd()
+                self._open(file_path, max_file_size, max_file_count)
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush()
+            finally:
+                self._close_fd()
+
 
 class DataLogger:
     """
     Responsible for writing metric data collected into a rotating set of files. Each set of files contains:
 
-    1. A metadata file, in the JSON format
+    1. A metadata file, in the JSON Lines format, with one row per metadata update
     2. A text data file
     """
     def __init__(self, data_file_dir, max_file_size=MAX_FILE_SIZE_BYTES, max_file_count=MAX_FILE_COUNT):
@@ -50,23 +254,36 @@ class DataLogger:
         self._max_file_size = max_file_size
         self._max_file_count = max_file_count
 
-        self._formatter = logging.Formatter("%(message)s")
-        self._rotating_file_handler = RotatingFileHandler(os.path.join(
-            self._data_dir_path, "cpu_temperatures"), maxBytes=self._max_file_size, backupCount=self._max_file_count)
-        self._rotating_file_handler.setFormatter(self._formatter)
-
-        self._console_handler = logging.StreamHandler()
-        self._console_handler.setFormatter(self._formatter)
+        self._sink = ThermalSink(os.path.join(self._data_dir_path, "cpu_temperatures"), self._max_file_size,
+                                 self._max_file_count)
+        self._min_data_type_value = LOGGING_LEVELS["INFO"]
 
-        self._logger = logging.getLogger()
-        self._logger.setLevel(logging.INFO)
-        self._logger.addHandler(self._rotating_file_handler)
-        self._logger.addHandler(self._console_handler)
+        # The sampling thread only enqueues the data. A single background thread drains the queue into the data file
+        # and the console, so a slow disk does not delay the next reading
+        self._queue = queue.SimpleQueue()
+        self._drain_thread = threading.Thread(target=self._drain)
+        self._drain_thread.daemon = True
+        self._drain_thread.start()
+        self._is_draining = True
+        atexit.register(self._close)
 
         self._metadata = METADATA
+        # Opened on the first metadata update, i.e. on start(), and then kept open
+        self._metadata_fd = None
 
     def set_logging_level(self, logging_level):
-        self._logger.setLevel(logging_level)
+        """
+        Set the lowest level of data to write.
+
+        :param logging_level: One of the logging level names, i.e. DEBUG, INFO, WARNING, ERROR, or CRITICAL
+        :type: str
+        :raise: ValueError
+        """
+        try:
+            self._min_data_type_value = LOGGING_LEVELS[logging_level]
+        except KeyError:
+            raise ValueError("Unknown logging level '{0}'. Make sure you provide one of: {1}".format(
+                logging_level, list(LOGGING_LEVELS)))
 
     def start(self):
         """
@@ -74,40 +291,145 @@ class DataLogger:
         update the metadata file.
         """
         self._metadata["collection_start"] = time.time()
-        self._write_metadata()
+        self._append_metadata("collection_start")
 
-    def _write_metadata(self):
+    def _append_metadata(self, key):
         """
-        Create a new metadata file with the latest available metadata written to that file.
+        Append the current value of a metadata key to the metadata file.
+
+        :param key: The metadata key
+        :type: str
         """
-        with open(os.path.join(self._data_dir_path, METADATA_FILE_NAME), 'w') as metadata_file:
-            json.dump(self._metadata, metadata_file, indent=4, separators=(',', ':'))
+        if self._metadata_fd is None:
+            # Keep the metadata file open so that each update is a single small append, not a rewrite of the whole file
+            self._metadata_fd = os.open(os.path.join(self._data_dir_path, METADATA_FILE_NAME),
+                                        os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
+            if os.fstat(self._metadata_fd).st_size == 0 and key != "__data_collection_version":
+                self._append_metadata("__data_collection_version")
+
+        value = self._metadata[key]
+        if isinstance(value, str):
+            # String values, unlike numbers, need quoting and escaping to be valid JSON
+            import json
+            value = json.dumps(value)
+        os.write(self._metadata_fd, METADATA_ROW_TEMPLATE.format(key, value, time.time()).encode())
 
     def write(self, data, data_type=DataType.INFO):
         """
-        Write data into a data file. This uses the logger object of Python. For warnings, errors, and exceptions, the
-        writer will switch to the corresponding logging method of the Python logger.
+        Write data into a data file, and to the console. For exceptions, the traceback of the exception being handled
+        is written after the data. Errors and exceptions are written to the data file right away; other data may wait
+        in a buffer. The data is only queued here; the actual write happens on the background drain thread.
 
-        :param data: The data to write to a file
-        :type: str
+        :param data: The data to write to a file. A tuple of strings is written as their concatenation, without building
+            the concatenated string
+        :type: str or tuple
         :param data_type: The type of data, i.e. the data INFO, or a WARNING, or an ERROR, or an EXCEPTION
         :type: Enum
         """
-        switcher = {
-            DataType.INFO: self._logger.info,
-            DataType.WARNING: self._logger.warning,
-            DataType.ERROR: self._logger.error,
-            DataType.EXCEPTION: self._logger.exception
-        }
+        if data_type not in WRITABLE_DATA_TYPES:
+            data = "Unknown data type '{0}'. Make sure you provide one of the supported data type values: {1}".format(
+                data_type, SUPPORTED_DATA_TYPES)
+            data_type = DataType.EXCEPTION
+
+        if data_type.value < self._min_data_type_value:
+            return
+
+        fragments = data + ("\n",) if isinstance(data, tuple) else ("{0}\n".format(data),)
+        if data_type == DataType.EXCEPTION:
+            # Only imported once an exception is actually written
+            import traceback
+            self._put((fragments + (traceback.format_exc(),), True))
+        else:
+            self._put((fragments, data_type == DataType.ERROR))
+
+    def _put(self, item):
+        """
+        Hand an item to the drain thread. Once the drain thread has stopped, at interpreter exit, write the item right
+        away instead, so that nothing written afterwards is lost.
 
-        handler = switcher.get(data_type, None)
-        handler(data) if handler else self._logger.exception(
-            "Unknown data type '{0}'. Make sure you provide one of the supported data type values: {1}".format(
-                data_type, [{i.name: i.value for i in DataType}]))
+        :param item: The data fragments and whether to flush them, or a function to call in order with the data
+        :type: tuple or callable
+        """
+        if self._is_draining:
+            self._queue.put_nowait(item)
+        else:
+            console_texts = []
+            self._write_item(item, console_texts)
+            self._write_item(self._sink.flush, console_texts)
+            sys.stderr.write("".join(console_texts))
+            sys.stderr.flush()
+
+    def _write_item(self, item, console_texts):
+        """
+        Write one queued item to the data file, and collect its text for the console. Errors are reported, not raised.
+
+        :param item: The data fragments and whether to flush them, or a function to call in order with the data
+        :type: tuple or callable
+        :param console_texts: The list to append the text to write to the console to
+        :type: list
+        """
+        try:
+            if callable(item):
+                item()
+                return
+
+            fragments = [str(fragment) for fragment in item[0]]
+            console_texts.extend(fragments)
+            self._sink.write([fragment.encode(DATA_FILE_ENCODING) for fragment in fragments], item[1])
+        except Exception as error:
+            _report_write_error(error)
+
+    def _drain(self):
+        """
+        Write the queued data to the data file and to the console, in batches, until the stop marker (None) is
+        dequeued, then close the data file. Queued functions, e.g. data file resets, are called in order with the data.
+        The data file buffer is also written out at least every flush interval, whether or not data keeps arriving.
+        """
+        next_flush_time = time.monotonic() + DATA_FLUSH_INTERVAL_SEC
+        while True:
+            if time.monotonic() >= next_flush_time:
+                try:
+                    self._sink.flush()
+                except Exception as error:
+                    _report_write_error(error)
+                next_flush_time = time.monotonic() + DATA_FLUSH_INTERVAL_SEC
+
+            try:
+                batch = [self._queue.get(timeout=max(0, next_flush_time - time.monotonic()))]
+            except queue.Empty:
+                continue
+
+            while batch[-1] is not None and len(batch) < DATA_DRAIN_BATCH_COUNT:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            is_stopping = batch[-1] is None
+            if is_stopping:
+                batch.pop()
+
+            # Handle the errors per item, and never let them end the thread: a failed write only loses that item
+            console_texts = []
+            for item in batch:
+                self._write_item(item, console_texts)
+
+            try:
+                sys.stderr.write("".join(console_texts))
+                sys.stderr.flush()
+            except Exception:
+                pass
+
+            if is_stopping:
+                try:
+                    self._sink.close()
+                except Exception as error:
+                    _report_write_error(error)
+                return
 
     def reset_file_handler(self, data_dir_path, max_file_size=None, max_file_count=None):
         """
-        Change the file handler so that the next data to write will be directed into a different data file, in a
+        Change the data file so that the next data to write will be directed into a different data file, in a
         different location in the data file hierarchy.
 
         :param data_dir_path: The new path to the root directory. This must end with the root directory name
@@ -120,16 +442,52 @@ class DataLogger:
             count
         :type: int
         """
-        self._rotating_file_handler = RotatingFileHandler(os.path.join(data_dir_path, "cpu_temperatures"),
-                                                          maxBytes=max_file_size if max_file_size else
-                                                          self._max_file_size,
-                                                          backupCount=max_file_count if max_file_count else
-                                                          self._max_file_count)
+        os.makedirs(data_dir_path, exist_ok=True)
+
+        # Reset through the queue, so that the data written before this call still goes to the current data file
+        self._put(functools.partial(self._sink.reset, os.path.join(data_dir_path, "cpu_temperatures"),
+                                                 max_file_size if max_file_size else self._max_file_size,
+                                                 max_file_count if max_file_count else self._max_file_count))
+
+    def _flush_sink(self, flushed):
+        try:
+            self._sink.flush()
+        finally:
+            flushed.set()
+
+    def _wait_drained(self):
+        """
+        Wait, for at most the drain timeout, until all the data queued so far is written to the data file.
+        """
+        if self._is_draining:
+            flushed = threading.Event()
+            self._queue.put_nowait(functools.partial(self._flush_sink, flushed))
+            flushed.wait(DATA_DRAIN_TIMEOUT_SEC)
+
+    def _stop_draining(self):
+        """
+        Write all the queued data, and stop the background drain thread, waiting for at most the drain timeout.
+        """
+        if self._is_draining:
+            self._is_draining = False
+            self._queue.put_nowait(None)
+            self._drain_thread.join(DATA_DRAIN_TIMEOUT_SEC)
+
+    def _close(self):
+        """
+        Stop the background drain thread, and close the metadata file. This runs at interpreter exit.
+        """
+        self._stop_draining()
+        if self._metadata_fd is not None:
+            os.close(self._metadata_fd)
+            self._metadata_fd = None
 
     def end(self):
         """
         Stop the data collection for the selected chart. This updates the "collection_end" timestamp, and update the
-        metadata file.
+        metadata file. All the data queued so far is written before returning, unless the data file stays blocked
+        for longer than the drain timeout.
         """
+        self._wait_drained()
         self._metadata["collection_end"] = time.time()
-        self._write_metadata()
+        self._append_metadata("collection_end")
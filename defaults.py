@@ -1,9 +1,15 @@
 import os
 
 
-METADATA_FILE_NAME = "metadata.json"
+METADATA_FILE_NAME = "metadata.jsonl"
 MAX_FILE_SIZE_BYTES = 7200
 MAX_FILE_COUNT = 30
+DATA_BUFFER_SIZE_BYTES = 64 * 1024
+DATA_FLUSH_INTERVAL_SEC = 30
+DATA_DRAIN_BATCH_COUNT = 256
+DATA_DRAIN_TIMEOUT_SEC = 5
+
+THERMAL_ZONE_FILE_PATH = "/sys/class/thermal/thermal_zone0/temp"
 
 DEFAULT_FILE_DIR = os.path.join('..', 'config')
 DEFAULT_CONFIG_FILE_NAME = "configs.json"
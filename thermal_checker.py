@@ -6,11 +6,10 @@ except ImportError:
     import errno
 import sys
 import time
-import datetime
-import json
-import argparse
+import functools
 
 from data_logger import DataLogger, DataType
+from defaults import THERMAL_ZONE_FILE_PATH
 
 
 # Store the log file to "./logs/"
@@ -23,21 +22,47 @@ except os.error as err:
 
 data_logger = DataLogger("logs", max_file_size=4000, max_file_count=10)
 
+CELSIUS_SUFFIX = "\xb0C"
+FAHRENHEIT_SUFFIX = "\xb0F"
 
-def _parse_configs(config_file_path):
+SESSION_SEPARATOR = '=' * 30
+READINGS_SEPARATOR = '-' * 30
+
+
+@functools.lru_cache(maxsize=4)
+def _load_configs(config_file_path, modified_time_ns):
     """
-    Parse the configuration file.
+    Load the configuration file. The results are cached per path and modification time, so that an unchanged
+    configuration file is parsed only once.
 
     :param config_file_path: The path to the configuration file (including the filename)
     :type: str
+    :param modified_time_ns: The modification time of the configuration file, in nanoseconds. Only used as part of the
+        cache key
+    :type: int
     :return: The configuration data
     :rtype: dict
     """
+    # Imported here, like argparse below, to keep them off the start-up path until they are needed
+    import json
+
     with open(config_file_path, 'r') as config_file:
         configs = json.load(config_file)
     return configs
 
 
+def _parse_configs(config_file_path):
+    """
+    Parse the configuration file, unless it has not changed since it was last parsed.
+
+    :param config_file_path: The path to the configuration file (including the filename)
+    :type: str
+    :return: The configuration data. This is shared with later calls, and must not be modified
+    :rtype: dict
+    """
+    return _load_configs(config_file_path, os.stat(config_file_path).st_mtime_ns)
+
+
 def _parse_arguments():
     """
     Parse the command arguments.
@@ -45,6 +70,8 @@ def _parse_arguments():
     :return: The command arguments as a dictionary
     :rtype: dict
     """
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="A tool to check whether SSH tunnels are opened for user-provided reverse-tunnel ports.")
 
@@ -62,18 +89,102 @@ def _parse_arguments():
     return args, extra_args
 
 
-def _count_down_sleep_status(sleep_secs):
+def _sleep_until(deadline):
+    """
+    Display the sleep status once, and sleep until the deadline. Sleeping until a deadline, instead of for a fixed
+    duration, keeps the time spent on reading and writing the data from delaying the next reading.
+
+    :param deadline: The time, as given by time.monotonic(), to wake up at
+    :type: float
     """
-    Display a countdown of the remaining sleep seconds.
+    sleep_secs = max(0, deadline - time.monotonic())
+    sys.stdout.write("\rSleeping for {0:.0f} seconds...".format(sleep_secs))
+    sys.stdout.flush()
+    time.sleep(sleep_secs)
+
 
-    :param sleep_secs: The number of seconds for sleep
+def _format_milli_degrees(milli_degrees):
+    """
+    Format a temperature given in thousandths of a degree with three decimals, using integer arithmetic only.
+
+    :param milli_degrees: The temperature, in thousandths of a degree
     :type: int
+    :return: The formatted temperature, without the unit
+    :rtype: str
+    """
+    whole, decimal = divmod(abs(milli_degrees), 1000)
+    return "%s%d.%03d" % ('-' if milli_degrees < 0 else '', whole, decimal)
+
+
+class ThermalSensor:
+    """
+    Reads the CPU temperature from the thermal zone file. The file is kept open across readings, and each reading is a
+    single positional read, since the kernel regenerates the file content every time it is read from the start.
     """
-    for i in range(sleep_secs, 0, -1):
-        sys.stdout.write("\rSleeping for {0} seconds...".format(i))
-        sys.stdout.flush()
-        time.sleep(1)
-        sys.stdout.flush()
+    def __init__(self, thermal_file_path=THERMAL_ZONE_FILE_PATH):
+        """
+        Open the thermal zone file.
+
+        :param thermal_file_path: The path to the thermal zone file, which contains the temperature in millidegrees
+            Celsius
+        :type: str
+        :raise: IOError
+        """
+        self._thermal_file_path = thermal_file_path
+        self._thermal_fd = os.open(self._thermal_file_path, os.O_RDONLY)
+
+    def read_milli_celsius(self):
+        """
+        Read the current temperature. If the read fails, reopen the thermal zone file and try once more.
+
+        :return: The temperature, in millidegrees Celsius
+        :rtype: int
+        :raise: IOError
+        """
+        try:
+            return int(os.pread(self._thermal_fd, 16, 0))
+        except IOError:
+            self.close()
+            self._thermal_fd = os.open(self._thermal_file_path, os.O_RDONLY)
+            return int(os.pread(self._thermal_fd, 16, 0))
+
+    def close(self):
+        if self._thermal_fd is not None:
+            os.close(self._thermal_fd)
+            self._thermal_fd = None
+
+
+def _write_session_banner(top_separator, bottom_separator):
+    """
+    Write the current time between two separators, as a single write.
+
+    :param top_separator: The separator to write above the time
+    :type: str
+    :param bottom_separator: The separator to write below the time
+    :type: str
+    """
+    data_logger.write("\n\n{0}\n{1}\n{2}".format(top_separator, time.strftime("%Y-%m-%d %H:%M:%S"), bottom_separator))
+
+
+def read_thermal_data(thermal_sensor):
+    """
+    Take one temperature reading.
+
+    :param thermal_sensor: The sensor to read the temperature from
+    :type: ThermalSensor
+    :return: The temperature in Celsius, and in Fahrenheit, each formatted with its unit
+    :rtype: tuple
+    :raise: IOError
+    """
+    milli_celsius = thermal_sensor.read_milli_celsius()
+    # F = C * 9 / 5 + 32, in thousandths of a degree. Adding 2 before the floor division by 5 rounds to the nearest
+    # thousandth, like round() did, instead of truncating; the fraction is a multiple of 1/5, so it is never a tie
+    milli_fahrenheit = (milli_celsius * 9 + 160002) // 5
+
+    c_reading = _format_milli_degrees(milli_celsius) + CELSIUS_SUFFIX
+    f_reading = _format_milli_degrees(milli_fahrenheit) + FAHRENHEIT_SUFFIX
+
+    return c_reading, f_reading
 
 
 def collect_thermal_readings(delay_sec, attempts):
@@ -86,33 +197,29 @@ def collect_thermal_readings(delay_sec, attempts):
     :type: int
     :raise: IOError
     """
-    def read_thermal_data():
-        file = open("/sys/class/thermal/thermal_zone0/temp", 'r')
-        milli_celsius = int(file.read().strip())
-        whole_celsius = milli_celsius // 1000
-        decimal_celsius = milli_celsius - whole_celsius * 1000
-
-        whole_fahrenheit = whole_celsius * 1.8 + 32
-        decimal_fahrenheit = decimal_celsius * 1.8 + 32
-
-        c_reading = str(round(milli_celsius / 1000, 3)) + "\xb0C"
-        f_reading = str(round(whole_fahrenheit + decimal_fahrenheit / 1000, 3)) + "\xb0F"
-
-        return c_reading, f_reading
-
+    thermal_sensor = None
     try:
+        thermal_sensor = ThermalSensor()
+
+        next_reading_time = time.monotonic()
         attempt_count = 0
         while attempt_count < attempts:
             attempt_count += 1
 
-            c_reading, f_reading = read_thermal_data()
+            c_reading, f_reading = read_thermal_data(thermal_sensor)
 
-            data_logger.write('\n' + c_reading + '\n' + f_reading)
+            data_logger.write(('\n', c_reading, '\n', f_reading))
 
-            _count_down_sleep_status(delay_sec)
+            # If the loop fell behind, e.g. after a system suspend, start again from now rather than catching up with
+            # back-to-back readings
+            next_reading_time = max(next_reading_time + delay_sec, time.monotonic())
+            _sleep_until(next_reading_time)
     except IOError:
         data_logger.write('\r')
         data_logger.write("Cannot find thermal data.\n".format(), DataType.ERROR)
+    finally:
+        if thermal_sensor:
+            thermal_sensor.close()
 
 
 def main():
@@ -135,17 +242,11 @@ def main():
 
     data_logger.start()
 
-    data_logger.write('\n')
-    data_logger.write('=' * 30)
-    data_logger.write(datetime.datetime.now())
-    data_logger.write('-' * 30)
+    _write_session_banner(SESSION_SEPARATOR, READINGS_SEPARATOR)
 
     collect_thermal_readings(delay_sec, attempts)
 
-    data_logger.write('\n')
-    data_logger.write('-' * 30)
-    data_logger.write(datetime.datetime.now())
-    data_logger.write('=' * 30)
+    _write_session_banner(READINGS_SEPARATOR, SESSION_SEPARATOR)
 
     data_logger.end()
 